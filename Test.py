@@ -1,30 +1,270 @@
 import argparse
-import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from queue import Empty, Queue
+from threading import BoundedSemaphore, Thread
 
-import numpy
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
+import yaml
 
 from models.common import DetectMultiBackend
 from utils.datasets import IMG_FORMATS, VID_FORMATS, LoadImages, LoadStreams
 from utils.general import (LOGGER, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
                            increment_path, non_max_suppression, print_args, scale_coords, strip_optimizer, xyxy2xywh)
 from utils.plots import Annotator, colors, save_one_box
-from utils.torch_utils import select_device, time_sync
-
-import json, zlib, base64
+from utils.torch_utils import select_device, smart_inference_mode, time_sync
+
+import json, base64
+
+
+def detection_matrix(boxes, shape):
+    # Count the xyxy boxes covering each pixel of an image of shape (h, w) with a 2D difference array
+    h, w = shape[:2]
+    xy = boxes.round().to(torch.int32).cpu().numpy()
+    x1, x2 = xy[:, [0, 2]].clip(0, w).T
+    y1, y2 = xy[:, [1, 3]].clip(0, h).T
+    m = np.zeros((h + 1, w + 1), np.int32)
+    np.add.at(m, (y1, x1), 1)
+    np.add.at(m, (y2, x2), 1)
+    np.add.at(m, (y1, x2), -1)
+    np.add.at(m, (y2, x1), -1)
+    np.cumsum(m, axis=0, out=m)
+    np.cumsum(m, axis=1, out=m)
+    return m[:-1, :-1]
+
+
+def preprocess(im, device, fp16=False, channels_last=False):
+    # uint8 numpy image(s) to a normalized batch on device, copied from pinned memory without blocking on CUDA
+    im = torch.from_numpy(im)
+    if device.type != 'cpu':
+        im = im.pin_memory().to(device, non_blocking=True)  # copy uint8, 1/4 the bytes of a cast-then-copy
+    im = im.half() if fp16 else im.float()  # uint8 to fp16/32 on device
+    im /= 255  # 0 - 255 to 0.0 - 1.0
+    if len(im.shape) == 3:
+        im = im[None]  # expand for batch dim
+    if channels_last:
+        im = im.contiguous(memory_format=torch.channels_last)  # NHWC to match the model
+    return im
+
+
+class Prefetcher:
+    # Iterates a LoadImages dataloader one frame ahead on a background thread, preprocessing each frame on a side
+    # CUDA stream while the current one runs inference. Mirrors the dataloader mode/frame/count of the current item,
+    # and its host-side preprocessing time as dt
+    def __init__(self, dataset, device, fp16=False, channels_last=False):
+        self.dataset, self.device, self.fp16, self.channels_last = dataset, device, fp16, channels_last
+        self.stream = torch.cuda.Stream(device) if device.type != 'cpu' else None
+        self.queue = Queue(maxsize=1)  # 1-deep: one frame staged while the current one is processed
+        self.thread = Thread(target=self.load, daemon=True)
+        self.mode, self.dt, self.stopped = dataset.mode, 0.0, False
+
+    @smart_inference_mode()  # as in run(): inference tensors, which the compiled model's guards were built for
+    def load(self):
+        try:
+            for path, im, im0s, vid_cap, s in self.dataset:
+                if self.stopped:
+                    break
+                state = {k: getattr(self.dataset, k) for k in ('mode', 'frame', 'count') if hasattr(self.dataset, k)}
+                t = time.time()  # not time_sync(), a device sync here would wait on inference
+                event = None
+                if self.stream:
+                    with torch.cuda.stream(self.stream):
+                        im = preprocess(im, self.device, self.fp16, self.channels_last)
+                        event = self.stream.record_event()
+                else:
+                    im = preprocess(im, self.device, self.fp16, self.channels_last)
+                state['dt'] = time.time() - t
+                self.queue.put((path, im, im0s, vid_cap, s, state, event))
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)  # re-raised on the consumer thread
+
+    def __iter__(self):
+        self.thread.start()
+        return self
+
+    def __next__(self):
+        x = self.queue.get()
+        if x is None:
+            raise StopIteration
+        if isinstance(x, Exception):
+            raise x
+        path, im, im0s, vid_cap, s, state, event = x
+        self.__dict__.update(state)
+        if event:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)  # copy done before inference reads im
+            im.record_stream(stream)  # im was allocated on the side stream, don't reuse its memory early
+        return path, im, im0s, vid_cap, s
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def close(self):
+        # Stop the loader thread, which may be blocked on a full queue when iteration ends early, and release the video
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)  # drop staged frames so a blocked put() returns
+            except Empty:
+                pass
+        if getattr(self.dataset, 'cap', None):
+            self.dataset.cap.release()
+
+
+class Writer(ThreadPoolExecutor):
+    # Runs disk writes in submission order on one background thread; submit() blocks once maxsize writes are pending.
+    # One thread keeps video frames in order and increment_path() crop names unique
+    def __init__(self, maxsize=16):
+        super().__init__(max_workers=1)
+        self.pending = BoundedSemaphore(maxsize)  # bounds the frames held in memory by queued writes
+
+    def submit(self, fn, *args, **kwargs):
+        self.pending.acquire()
+        future = super().submit(fn, *args, **kwargs)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        self.pending.release()
+        if future.exception():
+            LOGGER.warning(f'WARNING: background write failed: {future.exception()}')
+
+
+class Viewer:
+    # Shows frames from a background thread that only keeps the latest one, so inference never waits on the GUI
+    def __init__(self, name='frame', scale=0.5):
+        self.name, self.scale, self.hold = name, scale, False
+        self.queue = Queue(maxsize=1)
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+
+    def update(self):
+        try:
+            while True:
+                im = self.queue.get()
+                if im is None:
+                    break
+                h, w = im.shape[:2]
+                im = cv2.resize(im, (round(w * self.scale), round(h * self.scale)), interpolation=cv2.INTER_NEAREST)
+                cv2.imshow(self.name, im)
+                cv2.waitKey(1)  # 1 millisecond
+            if self.hold:
+                cv2.waitKey(0)  # keep the last frame open until a key is pressed
+        except Exception as e:  # i.e. headless OpenCV or no display
+            LOGGER.warning(f'WARNING: viewer stopped, frames will not be shown: {e}')
+
+    def show(self, im):
+        if not self.thread.is_alive():  # viewer failed or closed
+            return
+        try:
+            self.queue.get_nowait()  # drop the frame not shown yet
+        except Empty:
+            pass
+        self.queue.put_nowait(im)
+
+    def close(self, hold=False):
+        self.hold = hold
+        if self.thread.is_alive():
+            self.show(None)  # never blocks, a dead viewer leaves the queue full
+            self.thread.join()
+
+
+class FFmpegWriter:
+    # cv2.VideoWriter-like writer piping BGR frames to an ffmpeg subprocess that encodes H.264 on the GPU's NVENC.
+    # Falls back to cv2.VideoWriter if ffmpeg exits early, i.e. when the encoder can't open a session on this GPU
+    args = ['-preset', 'p1', '-pix_fmt', 'yuv420p']  # encoder options, shared with nvenc_available()
+
+    def __init__(self, file, fps, size, codec='h264_nvenc'):
+        self.file, self.fps, self.size, self.codec, self.n = str(file), fps, size, codec, 0
+        w, h = size
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{w}x{h}',
+               '-r', str(fps), '-i', '-', '-c:v', codec, *self.args, self.file]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.fallback = None  # cv2.VideoWriter once ffmpeg has died
+
+    def write(self, im):
+        if self.fallback is None:
+            try:
+                self.proc.stdin.write(np.ascontiguousarray(im).data)  # raw frame bytes, no copy for contiguous frames
+                self.n += 1
+                return
+            except OSError:  # BrokenPipeError, ffmpeg exited
+                self.stop()
+                # Reopening self.file would truncate what ffmpeg wrote, so continue in a new file unless it is empty
+                f = str(Path(self.file).with_name(f'{Path(self.file).stem}_mp4v.mp4')) if self.n else self.file
+                LOGGER.warning(f'WARNING: ffmpeg {self.codec} exited with code {self.proc.returncode} after {self.n} '
+                               f'frames in {self.file}, writing the remaining frames to {f} with cv2.VideoWriter')
+                self.fallback = cv2.VideoWriter(f, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, self.size)
+        self.fallback.write(im)
+
+    def stop(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:  # flushing into a broken pipe
+            pass
+        return self.proc.wait()
+
+    def release(self):
+        if self.fallback is not None:
+            self.fallback.release()
+        elif self.stop():
+            LOGGER.warning(f'WARNING: ffmpeg {self.codec} failed to encode {self.file} '
+                           f'(exit code {self.proc.returncode})')
+
+
+def nvenc_available():
+    # Check that ffmpeg on PATH can encode a frame with h264_nvenc and FFmpegWriter's options. Listing the encoder is
+    # not enough: most builds list it whether or not the GPU has an NVENC block (i.e. A100, H100 have none), and older
+    # NVENC builds lack the p1-p7 presets
+    if not shutil.which('ffmpeg'):
+        return False
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'color=s=256x256', '-frames:v', '1',
+           '-c:v', 'h264_nvenc', *FFmpegWriter.args, '-f', 'null', '-']
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=30).returncode == 0
+    except subprocess.TimeoutExpired:
+        return False
+
+
+def postprocess(det, im_shape, im0_shape, nc, gn=None, save_conf=False):
+    # Rescale (n,6) detections to im0 and derive per-class counts and, given gn, normalized labels on det's device
+    det[:, :4] = scale_coords(im_shape, det[:, :4], im0_shape).round()
+    counts = torch.bincount(det[:, 5].long(), minlength=nc)  # detections per class, one kernel
+    labels = None
+    if gn is not None:
+        xywhn = xyxy2xywh(det[:, :4]) / gn  # normalized xywh
+        labels = torch.cat((det[:, 5:], xywhn, det[:, 4:5]) if save_conf else (det[:, 5:], xywhn), 1)  # label format
+    return det, counts, labels
+
+
+def encode_result(m, frame, detections):
+    # Serialize a detection matrix as a length-prefixed JSON header followed by its raw uint8 counts
+    header = json.dumps({'frame': frame, 'detections': detections, 'shape': m.shape, 'dtype': 'u1'}).encode()
+    body = m.clip(0, 255).astype(np.uint8, copy=False).tobytes()  # counts saturate at 255
+    return len(header).to_bytes(4, 'little') + header + body
+
+
+def decode_result(buf):
+    # Inverse of encode_result(), returns the header dict with the detection matrix under 'matrix'
+    n = int.from_bytes(buf[:4], 'little')
+    header = json.loads(buf[4:4 + n])
+    header['matrix'] = np.frombuffer(buf[4 + n:], np.uint8).reshape(header['shape'])
+    return header
 
 
-# Reduce memory usage and speeds up computation by disabling gradient calculation
-@torch.no_grad()
 class Detection:
     def __init__(self, weights, source, data, imgsz, conf_thres, iou_thres, max_det, device, view_img, save_txt,
                  save_conf, save_crop,
                  nosave, classes, agnostic_nms, augment, visualize, update, project, name, exist_ok, line_thickness,
                  hide_labels,
-                 hide_conf, half, dnn, save_results):
+                 hide_conf, half, dnn, save_results, compile_model, export_trt):
         self.weights = weights  # model.pt path(s)
         self.source = source  # file/dir/URL/glob, 0 for webcam
         self.data = data  # dataset.yaml path
@@ -54,10 +294,43 @@ class Detection:
         self.hide_conf = hide_conf  # hide confidences
         self.half = half  # use FP16 half-precision inference
         self.dnn = dnn  # use OpenCV DNN for ONNX inference
+        self.compile_model = compile_model  # torch.compile() the PyTorch model (torch>=2.0)
+        self.export_trt = export_trt  # export *.pt weights to a FP16 TensorRT engine and infer with it
 
         self.save_results = save_results
-        self.results = {}
 
+    def export_engine(self):
+        # Build a FP16 TensorRT engine for imgsz beside the *.pt weights (once), return the (weights, data) to load it
+        w = Path(self.weights[0] if isinstance(self.weights, list) else self.weights)
+        if w.suffix != '.pt' or self.device.type == 'cpu':
+            LOGGER.warning(f'WARNING: --export-trt requires *.pt weights and a CUDA device, using {w}')
+            return self.weights, self.data
+        imgsz = check_img_size(self.imgsz, s=32)  # engine input shape, as LoadImages will letterbox to it
+        f = w.with_name(f'{w.stem}_{imgsz[0]}x{imgsz[1]}.engine')  # engines only accept the shape they were built for
+        data = f.with_suffix('.yaml')  # engines don't store class names, keep the checkpoint's beside them
+        if not f.exists() or w.stat().st_mtime > f.stat().st_mtime:  # missing, or older than retrained weights
+            for x in f, data:
+                if x.exists():
+                    x.unlink()  # stale
+            from export import run as export  # scoped to keep export dependencies optional
+            with tempfile.TemporaryDirectory() as tmp:  # export writes <stem>.onnx and <stem>.engine beside its input
+                t = Path(tmp) / w.name
+                shutil.copyfile(w, t)  # keeps any <stem>.engine/.onnx beside the user's weights untouched
+                export(weights=t, imgsz=imgsz, batch_size=1, device=str(self.device), include=('engine',), half=True,
+                       workspace=4)  # engines are GPU-specific, so build on the GPU that runs them
+                if t.with_suffix('.engine').exists():
+                    shutil.move(str(t.with_suffix('.engine')), f)
+        if not f.exists():
+            LOGGER.warning(f'WARNING: TensorRT export of {w} failed, using {w}')
+            return self.weights, self.data
+        if not data.exists():
+            ckpt = torch.load(w, map_location='cpu')
+            with open(data, 'w') as fd:
+                yaml.safe_dump({'names': (ckpt.get('ema') or ckpt['model']).names}, fd)
+        return str(f), str(data)
+
+    # Reduce memory usage and speeds up computation by disabling gradient calculation (warmup and loop alike)
+    @smart_inference_mode()
     def run(self):
         self.source = str(self.source)
         save_img = not self.nosave and not self.source.endswith('.txt')  # save inference LoadImages
@@ -74,164 +347,196 @@ class Detection:
 
         # Load model
         self.device = select_device(self.device)
-        model = DetectMultiBackend(self.weights, device=self.device, dnn=self.dnn, data=self.data, fp16=self.half)
+        weights, data = self.export_engine() if self.export_trt else (self.weights, self.data)
+        model = DetectMultiBackend(weights, device=self.device, dnn=self.dnn, data=data, fp16=self.half)
         stride, names, pt = model.stride, model.names, model.pt
         self.imgsz = check_img_size(self.imgsz, s=stride)  # check image size
+        channels_last = pt and model.fp16  # NHWC convolutions run on Tensor Cores in FP16 (CUDA only)
+        if channels_last:
+            model.model.to(memory_format=torch.channels_last)
+        compiled = self.compile_model and pt and hasattr(torch, 'compile')
+        if self.compile_model and not compiled:
+            LOGGER.warning('WARNING: --compile-model requires *.pt weights and torch>=2.0, running uncompiled')
+        auto = pt and not compiled  # minimum rectangle letterbox, exactly imgsz otherwise (static shape to compile)
 
         # Dataloader
         if webcam:
             self.view_img = check_imshow()
-            cudnn.benchmark = True  # set True to speed up constant image size inference
-            dataset = LoadStreams(self.source, img_size=self.imgsz, stride=stride, auto=pt)
+            dataset = LoadStreams(self.source, img_size=self.imgsz, stride=stride, auto=auto)
             bs = len(dataset)  # batch_size
         else:
-            dataset = LoadImages(self.source, img_size=self.imgsz, stride=stride, auto=pt)
+            images = LoadImages(self.source, img_size=self.imgsz, stride=stride, auto=auto)
+            dataset = Prefetcher(images, self.device, model.fp16, channels_last)
             bs = 1  # batch_size
+        # cuDNN autotunes per input shape, only worth it for constant image size inference: exactly imgsz (auto=False),
+        # streams (one letterbox shape) and videos. Image folders letterboxed with auto vary in shape per image
+        cudnn.benchmark = not auto or webcam or all(images.video_flag)
         vid_path, vid_writer = [None] * bs, [None] * bs
-
-        os.mkdir(save_dir / 'results') if not os.path.exists(save_dir / 'results') else None
-        with open(save_dir / 'results' / f'{self.source}.compressed', 'w') as f:
-            f.write('')
+        nvenc = save_img and self.device.type != 'cpu' and nvenc_available()  # encode videos with ffmpeg NVENC
+        viewer = Viewer() if self.view_img else None
+
+        writer = Writer()  # crops, images and video frames are written off the inference thread
+        results_fp = None  # detection matrices, opened once and appended to every frame
+        if self.save_results:
+            check_requirements(('zstandard',))
+            import zstandard as zstd
+            cctx = zstd.ZstdCompressor(level=3, threads=-1)  # reused across frames
+            (save_dir / 'results').mkdir(parents=True, exist_ok=True)
+            results_fp = open(save_dir / 'results' / f'{self.source}.compressed', 'wb', buffering=1 << 20)
 
         # Run inference
-        model.warmup(imgsz=(1 if pt else bs, 3, *self.imgsz))  # warmup
+        if compiled:
+            # Warm up with a frame of the real shape, dtype and memory format so the graph compiled (1st call) and the
+            # CUDA graph recorded (2nd call) are the ones replayed for every frame
+            model.model = torch.compile(model.model, mode='reduce-overhead', fullgraph=False)
+            im = preprocess(np.zeros((bs, 3, *self.imgsz), np.uint8), self.device, model.fp16, channels_last)
+            for _ in range(2):
+                model(im)
+        else:
+            model.warmup(imgsz=(1 if pt else bs, 3, *self.imgsz))  # warmup
         dt, seen = [0.0, 0.0, 0.0], 0
-
-        for path, im, im0s, vid_cap, s in dataset:
-            t1 = time_sync()
-            im = torch.from_numpy(im).to(self.device)
-            im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
-            if len(im.shape) == 3:
-                im = im[None]  # expand for batch dim
-            t2 = time_sync()
-            dt[0] += t2 - t1
-
-            # Inference
-            self.visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if self.visualize else False
-            pred = model(im, augment=self.augment, visualize=self.visualize)
-            t3 = time_sync()
-            dt[1] += t3 - t2
-
-            # NMS
-            pred = non_max_suppression(pred, self.conf_thres, self.iou_thres, self.classes, self.agnostic_nms,
-                                       max_det=self.max_det)
-            dt[2] += time_sync() - t3
-
-            # Second-stage classifier (optional)
-            # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
-
-            # Process predictions
-            for i, det in enumerate(pred):  # per image
-                seen += 1
-                if webcam:  # batch_size >= 1
-                    p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                    s += f'{i}: '
-                else:
-                    p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
-
-                p = Path(p)  # to Path
-                save_path = str(save_dir / p.name)  # im.jpg
-                txt_path = str(save_dir / 'labels' / p.stem) + (
-                    '' if dataset.mode == 'image' else f'_{frame}')  # im.txt
-                s += '%gx%g ' % im.shape[2:]  # print string
-                gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-                imc = im0.copy() if self.save_crop else im0  # for save_crop
-                annotator = Annotator(im0, line_width=self.line_thickness, example=str(names))
-
-                if len(det):
-                    # Rescale boxes from img_size to im0 size
-                    det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
-
-                    # Print results
-                    for c in det[:, -1].unique():
-                        n = (det[:, -1] == c).sum()  # detections per class
-                        s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                    # Write results
-                    for *xyxy, conf, cls in reversed(det):
-                        if self.save_txt:  # Write to file
-                            xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                            line = (cls, *xywh, conf) if self.save_conf else (cls, *xywh)  # label format
-                            with open(txt_path + '.txt', 'a') as f:
-                                f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                        if save_img or self.save_crop or self.view_img:  # Add bbox to image
-                            c = int(cls)  # integer class
-                            label = None if self.hide_labels else (
-                                names[c] if self.hide_conf else f'{names[c]} {conf:.2f}')
-                            annotator.box_label(xyxy, label, color=colors(c, True))
-                            if self.save_crop:
-                                save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-
-                    # Save detections in matrix format
-                    if self.save_results:
-                        m = np.zeros(im0s.shape[:2])
-                        for e in det[:, :4]:
-                            x1, y1, x2, y2 = e
-                            x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-                            m[y1:y2, x1:x2] += 1
-
-                        # Save matrix
-                        if not hasattr(dataset, 'frame'):
-                            dataset.frame = 1
-                        self.results = base64.b64encode(
-                            zlib.compress(
-                                json.dumps({"frame": dataset.frame, "detections": len(det),
-                                            "matrix": m.tolist()}).encode('utf-8')
-                            )
-                        ).decode('ascii')
-                        # os.mkdir(save_dir / 'results') if not os.path.exists(save_dir / 'results') else None
-
-                        # save to compressed numpy file
-                        with open(save_dir / 'results' / f'{self.source}.compressed', 'a') as f:
-                            f.write(f'{str(self.results)}\n')
-
-                        # decode compressed numpy file (y being the dictionary with all the frame data)
-                        # y = {}
-                        # with open(
-                        #         'C:\\Users\json\Documents\JetBrains\PycharmProjects\Test/runs\detect\exp/results/5.mp4.compressed',
-                        #         'r') as f:
-                        #     x = f.read().splitlines()
-                        #     for i, e in enumerate(x):
-                        #         y[str(i + 1)] = json.loads(zlib.decompress(base64.b64decode(e)))
-
-                        if dataset.frame == 5:
-                            raise Exception('stop')
-
-                    # Save results (image with detections)
-                    if save_img:
-                        if dataset.mode == 'image':
-                            cv2.imwrite(save_path, im0)
-                        else:  # 'video' or 'stream'
-                            if vid_path[i] != save_path:  # new video
-                                vid_path[i] = save_path
-                                if isinstance(vid_writer[i], cv2.VideoWriter):
-                                    vid_writer[i].release()  # release previous video writer
-                                if vid_cap:  # video
-                                    fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                                    w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                                    h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                                else:  # stream
-                                    fps, w, h = 30, im0.shape[1], im0.shape[0]
-                                save_path = str(
-                                    Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                                vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                            vid_writer[i].write(im0)
-
-            """ REMOVE THIS ONCE YOU CAN STREAM THE IMAGES IN THE GUI"""
-            # Stream results
-            im0 = annotator.result()
-            if self.view_img and im0.any():
-                # cv2.imshow(str(p), cv2.resize(im0, (1920, 1080)))
-                # cv2.imshow(str(p), im0)
-                # cv2.imshow(f'Frame: {dataset.frame} File:{str(p)}', cv2.resize(im0, (round(im0.shape[1] * 0.5),
-                #                                                                      round(im0.shape[0] * 0.5))))
-                cv2.imshow('frame', cv2.resize(im0, (round(im0.shape[1] * 0.5), round(im0.shape[0] * 0.5))))
-                if webcam:
-                    cv2.waitKey(1)  # 1 millisecond
+        visualize = self.visualize and pt  # only PyTorch models write feature maps
+        example, labels_dir, gains = str(names), save_dir / 'labels', {}  # loop invariants, gains keyed by im0 shape
+
+        try:
+            for path, im, im0s, vid_cap, s in dataset:
+                t1 = time_sync()
+                if webcam:  # LoadImages frames arrive preprocessed from the Prefetcher, which times them itself
+                    im = preprocess(im, self.device, model.fp16, channels_last)
+                t2 = time_sync()
+                dt[0] += t2 - t1 if webcam else dataset.dt
+
+                # Inference
+                if visualize:
+                    feature_dir = increment_path(save_dir / Path(path).stem, mkdir=True)
+                    pred = model(im, augment=self.augment, visualize=feature_dir)
                 else:
-                    cv2.waitKey(1)
+                    pred = model(im, augment=self.augment)
+                t3 = time_sync()
+                dt[1] += t3 - t2
+
+                # NMS
+                pred = non_max_suppression(pred, self.conf_thres, self.iou_thres, self.classes, self.agnostic_nms,
+                                           max_det=self.max_det)
+                dt[2] += time_sync() - t3
+
+                # Second-stage classifier (optional)
+                # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
+
+                # Process predictions
+                for i, det in enumerate(pred):  # per image
+                    seen += 1
+                    if webcam:  # batch_size >= 1
+                        # LoadStreams can hand back the same buffer twice, copy before drawing on it
+                        p, im0, frame = path[i], im0s[i].copy(), dataset.count
+                        s += f'{i}: '
+                    else:  # LoadImages reads a fresh array per frame, draw on it in place
+                        p, im0, frame = path, im0s, getattr(dataset, 'frame', 0)
+
+                    p = Path(p)  # to Path
+                    save_path = str(save_dir / p.name)  # im.jpg
+                    txt_path = str(labels_dir / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
+                    s += '%gx%g ' % im.shape[2:]  # print string
+                    imc = im0.copy() if self.save_crop else im0  # for save_crop
+                    annotator = Annotator(im0, line_width=self.line_thickness, example=example)
+
+                    if len(det):
+                        # Rescale boxes from img_size to im0 size, count classes and build labels in one pass
+                        gn = None
+                        if self.save_txt:
+                            gn = gains.get(im0.shape)
+                            if gn is None:  # constant for a video, cached per shape for images and streams
+                                gn = gains[im0.shape] = torch.tensor(im0.shape, device=det.device)[[1, 0, 1, 0]]  # whwh
+                        det, counts, labels = postprocess(det, im.shape[2:], im0.shape, len(names), gn, self.save_conf)
+
+                        # Print results
+                        for c, n in enumerate(counts.tolist()):
+                            if n:
+                                s += f"{n} {names[c]}{'s' * (n > 1)}, "  # add to string
+
+                        # Write results
+                        boxes = det.tolist()  # one copy to host
+                        if self.save_txt:  # Write to file, one append per frame
+                            with open(txt_path + '.txt', 'ab') as f:
+                                np.savetxt(f, labels.flip(0).cpu().numpy(), fmt='%g')  # reversed like the boxes
+
+                        for *xyxy, conf, cls in reversed(boxes):
+                            if save_img or self.save_crop or self.view_img:  # Add bbox to image
+                                c = int(cls)  # integer class
+                                label = None if self.hide_labels else (
+                                    names[c] if self.hide_conf else f'{names[c]} {conf:.2f}')
+                                annotator.box_label(xyxy, label, color=colors(c, True))
+                                if self.save_crop:
+                                    writer.submit(save_one_box, xyxy, imc, file=save_dir / 'crops' / names[c] /
+                                                  f'{p.stem}.jpg', BGR=True)
+
+                        # Save detections in matrix format
+                        if self.save_results:
+                            m = detection_matrix(det[:, :4], im0.shape)
+
+                            # Save matrix
+                            if not hasattr(dataset, 'frame'):
+                                dataset.frame = 1
+                            payload = base64.b64encode(cctx.compress(encode_result(m, dataset.frame, len(det))))
+
+                            # save to compressed numpy file
+                            results_fp.write(payload)
+                            results_fp.write(b'\n')
+
+                            # decode compressed numpy file (y being the dictionary with all the frame data)
+                            # y, dctx = {}, zstd.ZstdDecompressor()
+                            # with open(
+                            #         'C:\\Users\json\Documents\JetBrains\PycharmProjects\Test/runs\detect\exp/results/5.mp4.compressed',
+                            #         'rb') as f:
+                            #     x = f.read().splitlines()
+                            #     for i, e in enumerate(x):
+                            #         y[str(i + 1)] = decode_result(dctx.decompress(base64.b64decode(e)))
+
+                            if dataset.frame == 5:
+                                raise Exception('stop')
+
+                        # Save results (image with detections)
+                        if save_img:
+                            if dataset.mode == 'image':
+                                writer.submit(cv2.imwrite, save_path, im0)
+                            else:  # 'video' or 'stream'
+                                if vid_path[i] != save_path:  # new video
+                                    vid_path[i] = save_path
+                                    if vid_writer[i] is not None:
+                                        writer.submit(vid_writer[i].release)  # release previous video writer
+                                    if vid_cap:  # video
+                                        fps = vid_cap.get(cv2.CAP_PROP_FPS)
+                                        w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                                        h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                                    else:  # stream
+                                        fps, w, h = 30, im0.shape[1], im0.shape[0]
+                                    save_path = str(
+                                        Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
+                                    if nvenc:
+                                        vid_writer[i] = FFmpegWriter(save_path, fps, (w, h))
+                                    else:
+                                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'),
+                                                                        fps, (w, h))
+                                writer.submit(vid_writer[i].write, im0)
+
+                """ REMOVE THIS ONCE YOU CAN STREAM THE IMAGES IN THE GUI"""
+                # Stream results
+                im0 = annotator.result()
+                if viewer and im0.size:  # O(1), unlike a full-frame any() scan
+                    viewer.show(im0)  # drawn at half size on the viewer thread
+        except BaseException:
+            if viewer:
+                viewer.close()  # no hold on errors, the final close(hold=True) below is not reached
+            raise
+        finally:
+            if isinstance(dataset, Prefetcher):
+                dataset.close()
+            for w in vid_writer:
+                if w is not None:
+                    writer.submit(w.release)  # finalize videos after their last queued frame
+            writer.shutdown()  # drain pending writes
+            if results_fp:
+                results_fp.close()
 
         # Print results
         t = tuple(x / seen * 1E3 for x in dt)  # speeds per image
@@ -242,7 +547,7 @@ class Detection:
             LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
         if self.update:
             strip_optimizer(self.weights)  # update model (to fix SourceChangeWarning)
-        cv2.waitKey(0)
+        viewer.close(hold=True) if viewer else cv2.waitKey(0)
 
 
 def main():
@@ -296,6 +601,8 @@ if __name__ == "__main__":
     parser.add_argument('--dnn', default=False, action='store_true', help='use OpenCV DNN for ONNX inference')
 
     parser.add_argument('--save-results', default=False, action='store_true', help='save matrix')
+    parser.add_argument('--compile-model', default=False, action='store_true', help='torch.compile() the model')
+    parser.add_argument('--export-trt', default=False, action='store_true', help='infer with a FP16 TensorRT engine')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
 